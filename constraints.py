@@ -1,170 +1,363 @@
+from google.protobuf import text_format
 from ortools.sat.python import cp_model
+from collections import Counter, defaultdict
 from math import lcm
+import hashlib
+import os
 
+# how many built models to keep on disk
+MODEL_CACHE_SIZE = 8
 
-def plan_schedule(config, lines):
-    num_slots = int(config["irrigation"]["daily_slots"])
-    slot_minutes = int(config["irrigation"]["slot_minutes"])
 
+def line_starts(lines, num_slots):
+    # every (line, day, slot) a line can start on; the model creates one variable
+    # for each of these, in this order, before anything else
+    return [
+        (l, d0, s0)
+        for l, line in enumerate(lines)
+        for d0 in range(line.interval)
+        for s0 in range(num_slots)
+    ]
+
+
+def slot_starts(lines, num_days, num_slots):
+    # A line runs every `interval` days, moving on to the next slot each time,
+    # so its whole schedule follows from the day and slot it starts on. Map
+    # every (line, day, slot) onto the start that reaches it.
+    slots = {}
+    for l, line in enumerate(lines):
+        for d in range(num_days):
+            # day d is run k of a schedule that started on day d0
+            k, d0 = divmod(d, line.interval)
+            for s in range(num_slots):
+                slots[(l, d, s)] = (l, d0, (s - k) % num_slots)
+    return slots
+
+
+def line_runs(line, d0, s0, num_days, num_slots):
+    # the (day, slot) of every run of a line that starts on day d0, slot s0
+    return [
+        (d, (s0 + k) % num_slots)
+        for k, d in enumerate(range(d0, num_days, line.interval))
+    ]
+
+
+def splash_indices(lines):
     line_dict = {}
     for index, l in enumerate(lines):
         line_dict[l.name] = index
-    splash_lines = []
-    for l in lines:
-        new_splash = [line_dict[n] for n in l.splash]
-        splash_lines.append(l._replace(splash=new_splash))
-    num_lines = len(lines)
+    return [[line_dict[n] for n in l.splash] for l in lines]
 
-    intervals = []
-    for l in lines:
-        if l.interval not in intervals:
-            intervals.append(l.interval)
-    max_interval = lcm(*intervals)
-    line_targets = []
-    for l in lines:
-        target = (max_interval // l.interval) * num_slots
-        line_targets.append(target)
 
-    num_days = max_interval * num_slots
+def interchangeable_lines(lines):
+    # Swapping the schedules of two lines with the same interval, duration,
+    # group and splash neighbours gives an equivalent schedule. Returns those
+    # lines grouped together, each group in index order.
+    splash_idx = splash_indices(lines)
+    splashed_by = [[] for l in lines]
+    for l, splash in enumerate(splash_idx):
+        for sp in splash:
+            splashed_by[sp].append(l)
+    equivalent_lines = defaultdict(list)
+    for l, line in enumerate(lines):
+        key = (
+            line.interval,
+            line.duration,
+            line.group,
+            frozenset(splash_idx[l]),
+            frozenset(splashed_by[l]),
+        )
+        equivalent_lines[key].append(l)
+    return [members for members in equivalent_lines.values() if len(members) > 1]
+
+
+def build_model(lines, num_slots, num_days, slot_minutes):
+    splash_idx = splash_indices(lines)
+    num_lines = len(lines)
+
     all_lines = range(num_lines)
     all_slots = range(num_slots)
     all_days = range(num_days)
     model = cp_model.CpModel()
 
-    slots = {}
+    # the starts are looked up by proto index later on, so they need no names
+    starts = {key: model.NewBoolVar("") for key in line_starts(lines, num_slots)}
+    slot_start = slot_starts(lines, num_days, num_slots)
+
+    # total and per-group minutes of every (day, slot), built once and shared
+    # by the constraints below
+    durations = [l.duration for l in lines]
+    group_lines = {
+        "A": [],
+        "B": [],
+    }
     for l in all_lines:
-        for d in all_days:
-            for s in all_slots:
-                slots[(l, d, s)] = model.NewBoolVar("slot_l%id%is%i" % (l, d, s))
+        group_lines[lines[l].group].append(l)
+    group_durations = {
+        group: [durations[l] for l in members] for group, members in group_lines.items()
+    }
+    slot_time = []
+    group_time = []
+    for d in all_days:
+        for s in all_slots:
+            slot_vars = [starts[slot_start[(l, d, s)]] for l in all_lines]
+            slot_time.append(cp_model.LinearExpr.WeightedSum(slot_vars, durations))
+            group_time.append(
+                {
+                    group: cp_model.LinearExpr.WeightedSum(
+                        [slot_vars[l] for l in members], group_durations[group]
+                    )
+                    for group, members in group_lines.items()
+                }
+            )
 
     ## hard constraints
 
-    # limit slot duration
-    for d in all_days:
-        for s in all_slots:
-            slot_tasks = []
-            for l in all_lines:
-                slot_tasks.append(lines[l].duration * slots[(l, d, s)])
-            model.Add(sum(slot_tasks) <= slot_minutes)
+    # limit slot duration: every line is in group A or B, so the group limits
+    # below already keep each slot within slot_minutes
 
     # equal time for each group within a slot
     # TODO: make the groups and group combos configurable
-    group_mismatch = []
-    for d in all_days:
-        for s in all_slots:
-            group_tasks = {
-                "A": [],
-                "B": [],
-            }
-            for l in all_lines:
-                group_tasks[lines[l].group].append(lines[l].duration * slots[(l, d, s)])
-            group_limit = slot_minutes // 2
-            model.Add(sum(group_tasks["A"]) > 0)
-            model.Add(sum(group_tasks["A"]) <= group_limit)
-            model.Add(sum(group_tasks["B"]) > 0)
-            model.Add(sum(group_tasks["B"]) <= group_limit)
-
-    # meet line targets
+    # (a group that waters at all runs for at least its shortest line)
+    group_limit = slot_minutes // 2
+    shortest = {
+        group: min(group_durations[group], default=1) for group in group_durations
+    }
+    for group_totals in group_time:
+        model.Add(group_totals["A"] >= shortest["A"])
+        model.Add(group_totals["A"] <= group_limit)
+        model.Add(group_totals["B"] >= shortest["B"])
+        model.Add(group_totals["B"] <= group_limit)
+
+    # each line starts exactly once, which also makes it meet its target
     for l in all_lines:
-        line_slots = []
-        for d in all_days:
-            for s in all_slots:
-                line_slots.append(slots[(l, d, s)])
-        model.Add(sum(line_slots) == line_targets[l])
-
-    # line intervals and alternating slot
-    def add_checked_implication(l, d, s, nd, ns, implied):
-        if nd >= num_days or ns >= num_slots:
-            return
-        if implied:
-            model.AddImplication(slots[(l, d, s)], slots[(l, nd, ns)])
-        else:
-            model.AddImplication(slots[(l, d, s)], slots[(l, nd, ns)].Not())
+        model.AddExactlyOne(
+            starts[(l, d0, s0)] for d0 in range(lines[l].interval) for s0 in all_slots
+        )
 
-    for d in all_days:
-        for s in all_slots:
-            for l in all_lines:
-                next_d = d + lines[l].interval
-                next_s = (s + 1) % num_slots
-                # a slot implies the correct next day and slot...
-                add_checked_implication(l, d, s, next_d, next_s, True)
-                # ...and none of the days and slots inbetween
-                nd = d
-                ns = s
-                while True:
-                    ns += 1
-                    if ns == num_slots:
-                        ns = 0
-                        nd += 1
-                    if nd == next_d and ns == next_s:
-                        break
-                    add_checked_implication(l, d, s, nd, ns, False)
+    # order the starts of interchangeable lines so the solver only explores one
+    # of their equivalent schedules
+    def start_position(l):
+        keys = [(l, d0, s0) for d0 in range(lines[l].interval) for s0 in all_slots]
+        return cp_model.LinearExpr.WeightedSum(
+            [starts[key] for key in keys], [d0 * num_slots + s0 for _, d0, s0 in keys]
+        )
+
+    for members in interchangeable_lines(lines):
+        for a, b in zip(members, members[1:]):
+            model.Add(start_position(a) <= start_position(b))
 
     ## soft constraints
 
     # even out slot load
     slotload = []
-    for d in all_days:
-        for s in all_slots:
-            tmp = model.NewIntVar(0, slot_minutes, "")
-            model.Add(
-                tmp == sum([(slots[(l, d, s)] * lines[l].duration) for l in all_lines])
-            )
-            slotload.append(tmp)
-    objective = model.NewIntVar(0, slot_minutes, "")
-    model.AddMinEquality(objective, slotload)
-    model.Maximize(objective)
+    for slot_total in slot_time:
+        tmp = model.NewIntVar(0, slot_minutes, "")
+        model.Add(tmp == slot_total)
+        slotload.append(tmp)
+    min_slotload = model.NewIntVar(0, slot_minutes, "")
+    model.AddMinEquality(min_slotload, slotload)
 
     # minimize group mismatch
     groupdiff = []
-    for d in all_days:
-        for s in all_slots:
-            group_tasks = {
-                "A": [],
-                "B": [],
-            }
-            for l in all_lines:
-                group_tasks[lines[l].group].append(lines[l].duration * slots[(l, d, s)])
-            group_limit = slot_minutes // 2
-            tmp = model.NewIntVar(0, slot_minutes, "")
-            model.AddAbsEquality(tmp, sum(group_tasks["A"]) - sum(group_tasks["B"]))
-            groupdiff.append(tmp)
-    objective = model.NewIntVar(0, slot_minutes, "")
-    model.AddMaxEquality(objective, groupdiff)
-    model.Minimize(objective)
+    for group_totals in group_time:
+        tmp = model.NewIntVar(0, slot_minutes, "")
+        model.AddAbsEquality(tmp, group_totals["A"] - group_totals["B"])
+        groupdiff.append(tmp)
+    max_groupdiff = model.NewIntVar(0, slot_minutes, "")
+    model.AddMaxEquality(max_groupdiff, groupdiff)
 
     # minimize overlapping splash
-    splashes = [0]
+    # Two lines that splash onto each other overlap on every run they share,
+    # and which runs those are only depends on the pair of starts. So count the
+    # shared runs per pair of starts once, and give each pair a Boolean that is
+    # forced on when both starts are picked.
+    splash_pairs = set()
     for l in all_lines:
+        for sp in splash_idx[l]:
+            splash_pairs.add((min(l, sp), max(l, sp)))
+    shared_runs = Counter()
+    for a, b in splash_pairs:
         for d in all_days:
             for s in all_slots:
-                splash = [slots[(l, d, s)]]
-                splash.extend(slots[(sp, d, s)] for sp in splash_lines[l].splash)
-                tmp = model.NewIntVar(0, num_lines, "")
-                model.Add(tmp == sum(splash))
-                splashes.append(tmp)
-    objective = model.NewIntVar(0, num_lines, "")
-    model.AddMaxEquality(objective, splashes)
-    model.Minimize(objective)
+                shared_runs[(slot_start[(a, d, s)], slot_start[(b, d, s)])] += 1
+    overlaps = []
+    for start_a, start_b in shared_runs:
+        overlap = model.NewBoolVar("")
+        model.AddBoolOr([starts[start_a].Not(), starts[start_b].Not(), overlap])
+        overlaps.append(overlap)
+    splash_overlap = cp_model.LinearExpr.WeightedSum(
+        overlaps, list(shared_runs.values())
+    )
+
+    # CP-SAT only keeps the last objective set on the model, so combine them
+    # into one. Each weight exceeds the range of the terms below it, which
+    # makes this lexicographic: splash overlap first, then group mismatch, then
+    # slot load.
+    load_weight = 1
+    groupdiff_weight = (slot_minutes + 1) * load_weight
+    splash_weight = (slot_minutes + 1) * groupdiff_weight
+    model.Minimize(
+        load_weight * (slot_minutes - min_slotload)
+        + groupdiff_weight * max_groupdiff
+        + splash_weight * splash_overlap
+    )
+
+    return model
+
+
+def greedy_starts(lines, num_slots, num_days, slot_minutes):
+    # Quick schedule to seed the solver with: longest lines first, each on the
+    # start whose busiest run has the most room left in the line's group.
+    group_limit = slot_minutes // 2
+    used = defaultdict(int)
+    chosen = {}
+    for l in sorted(range(len(lines)), key=lambda l: -lines[l].duration):
+        line = lines[l]
+        best = None
+        for d0 in range(line.interval):
+            for s0 in range(num_slots):
+                runs = line_runs(line, d0, s0, num_days, num_slots)
+                busiest = max(used[(d, s, line.group)] for d, s in runs)
+                if busiest + line.duration > group_limit:
+                    continue
+                if best is None or busiest < best[0]:
+                    best = (busiest, (d0, s0), runs)
+        if best is None:
+            continue
+        for d, s in best[2]:
+            used[(d, s, line.group)] += line.duration
+        chosen[l] = best[1]
+    return chosen
+
+
+def model_cache_path(lines, num_slots, slot_minutes):
+    # key the cache on everything that shapes the model, including this file so
+    # that changing how the model is built invalidates it
+    digest = hashlib.sha256()
+    digest.update(repr((num_slots, slot_minutes, tuple(lines))).encode())
+    with open(__file__, "rb") as f:
+        digest.update(f.read())
+    cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "irrigation-scheduler", digest.hexdigest() + ".pb")
+
+
+def load_cached_model(cache_path):
+    # the cache is only a shortcut, so a missing, unreadable or damaged file
+    # just means building the model again
+    try:
+        with open(cache_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # the serialized model is stored after its checksum, see save_cached_model
+    checksum, proto = data[:32], data[32:]
+    if hashlib.sha256(proto).digest() != checksum:
+        return None
+    model = cp_model.CpModel()
+    model.Proto().ParseFromString(proto)
+    # mark it as recently used, so pruning keeps it
+    try:
+        os.utime(cache_path)
+    except OSError:
+        pass
+    return model
+
+
+def save_cached_model(cache_path, model):
+    # a truncated model can still parse, so store a checksum in front of it
+    proto = model.Proto().SerializeToString()
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_path + ".tmp", "wb") as f:
+            f.write(hashlib.sha256(proto).digest() + proto)
+        os.replace(cache_path + ".tmp", cache_path)
+        # every change to the lines gives a new file, so only keep the models
+        # used most recently
+        cached = sorted(
+            (entry for entry in os.scandir(cache_dir) if entry.name.endswith(".pb")),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in cached[MODEL_CACHE_SIZE:]:
+            os.remove(entry.path)
+    except OSError as e:
+        print(f"Could not cache the model: {e}")
+
+
+def plan_schedule(config, lines, prior_solution=None):
+    num_slots = int(config["irrigation"]["daily_slots"])
+    slot_minutes = int(config["irrigation"]["slot_minutes"])
+
+    # every line's schedule repeats once the slot rotation lines up with the
+    # common multiple of all intervals
+    max_interval = lcm(*{l.interval for l in lines})
+    num_days = max_interval * num_slots
+    all_slots = range(num_slots)
+    all_days = range(num_days)
+
+    # building the model takes a while, so reuse it when nothing changed
+    cache_path = model_cache_path(lines, num_slots, slot_minutes)
+    model = load_cached_model(cache_path)
+    if model is None:
+        model = build_model(lines, num_slots, num_days, slot_minutes)
+        save_cached_model(cache_path, model)
+    starts = {}
+    for index, key in enumerate(line_starts(lines, num_slots)):
+        starts[key] = model.GetBoolVarFromProtoIndex(index)
+
+    # start the search from a previous schedule, for the lines it still fits,
+    # or else from a greedy one
+    if prior_solution is not None:
+        prior_starts = {line.name: plan[0] for line, plan in prior_solution[1].items()}
+        hint = {}
+        for l, line in enumerate(lines):
+            prior_start = prior_starts.get(line.name)
+            if prior_start is not None and (l, *prior_start) in starts:
+                hint[l] = prior_start
+    else:
+        hint = greedy_starts(lines, num_slots, num_days, slot_minutes)
+    # interchangeable lines have to start in index order, see build_model, which
+    # a prior schedule won't follow if the lines came back in another order
+    for members in interchangeable_lines(lines):
+        hinted = [l for l in members if l in hint]
+        for l, start in zip(hinted, sorted(hint[l] for l in hinted)):
+            hint[l] = start
+    for l, hint_start in hint.items():
+        for d0 in range(lines[l].interval):
+            for s0 in all_slots:
+                model.AddHint(starts[(l, d0, s0)], int(hint_start == (d0, s0)))
 
     solver = cp_model.CpSolver()
-    solver.parameters.linearization_level = 0
-    solver.parameters.enumerate_all_solutions = True
+    # every decision variable is a Boolean, which core-based search with a
+    # light Boolean encoding handles well
+    solver.parameters.optimize_with_core = True
+    solver.parameters.boolean_encoding_level = 0
+    # the model is small enough that LP cuts pay for themselves
+    solver.parameters.linearization_level = 2
+    solver.parameters.num_search_workers = os.cpu_count() or 1
+    # settle for the best schedule found so far rather than proving optimality
+    solver.parameters.max_time_in_seconds = 120
+    # any other CP-SAT parameter can be set from the [solver] config section
+    if config.has_section("solver"):
+        text_format.Merge(
+            "\n".join(f"{name}: {value}" for name, value in config.items("solver")),
+            solver.parameters,
+        )
 
     status = solver.Solve(model)
     if status == cp_model.OPTIMAL or status == cp_model.FEASIBLE:
-        days_plan = []
+        # each line's runs follow from the one start the solver picked for it
+        days_plan = [[[] for s in all_slots] for d in all_days]
         line_plan = {}
-        for d in all_days:
-            day_plan = []
-            for s in all_slots:
-                slot_plan = []
-                for l in all_lines:
-                    if solver.Value(slots[(l, d, s)]):
-                        slot_plan.append(lines[l])
-                        line_plan.setdefault(lines[l], []).append((d, s))
-                day_plan.append(slot_plan)
-            days_plan.append(day_plan)
+        for (l, d0, s0), start in starts.items():
+            if not solver.BooleanValue(start):
+                continue
+            line = lines[l]
+            line_plan[line] = line_runs(line, d0, s0, num_days, num_slots)
+            for d, s in line_plan[line]:
+                days_plan[d][s].append(line)
         solution = [days_plan, line_plan]
     else:
         solution = None
@@ -1,15 +1,21 @@
 import asyncio
+import contextlib
 import pyopensprinkler
 import json
 import sys
+from collections import defaultdict
 
 
+@contextlib.asynccontextmanager
 async def get_controller(config):
     controller = pyopensprinkler.Controller(
         config["opensprinkler"]["controller"], config["opensprinkler"]["password"]
     )
-    await controller.refresh()
-    return controller
+    try:
+        await controller.refresh()
+        yield controller
+    finally:
+        await controller.session_close()
 
 
 def get_program(controller, name):
@@ -29,12 +35,10 @@ def debugln(s):
 
 
 async def create_program(controller, name, stations, interval, remainder, start_time):
-    debug(name + ": ")
     # Manually build create program request, so that it can be done in one API call
     # with all the parameters set to the desired values.
-    durations = []
-    for i in range(len(controller.stations)):
-        durations.append(stations.get(i, 0))
+    num_stations = len(controller.stations)
+    durations = [stations.get(i, 0) for i in range(num_stations)]
     # bit 0: program enable 'en' bit (1: enabled; 0: disabled)
     # bit 1: use weather adjustment 'uwt' bit (1: yes; 0: no)
     # bit 2-3: odd/even restriction (0: none; 1: odd-day restriction; 2: even-day restriction; 3: undefined)
@@ -56,33 +60,36 @@ async def create_program(controller, name, stations, interval, remainder, start_
         "name": name,
         "v": json.dumps(data).replace(" ", ""),
     }
-    await controller.request("/cp", params)
-    debugln("done")
+    # Nothing reads the programs back, so skip the settle delay and full refresh
+    # the library does after every update.
+    await controller.request("/cp", params, refresh_on_update=False)
+    debugln(name + ": done")
 
 
 def stations_and_durations(station_map, lines):
-    groups = {}
+    groups = defaultdict(int)
     scale_group = None
-    scale_factor = 1
+    # kept as a ratio so durations stay whole seconds
+    scale_num = scale_den = 1
     # ensure that group durations match
     for line in lines:
-        groups[line.group] = groups.get(line.group, 0) + line.duration
+        groups[line.group] += line.duration
     # TODO: assuming two groups
     values = list(groups.values())
     keys = list(groups.keys())
     if values[0] != values[1]:
         if values[0] < values[1]:
             scale_group = keys[0]
-            scale_factor = values[1] / values[0]
+            scale_num, scale_den = values[1], values[0]
         else:
             scale_group = keys[1]
-            scale_factor = values[0] / values[1]
+            scale_num, scale_den = values[0], values[1]
     result = {}
     for line in lines:
         duration = line.duration * 60
         if line.group == scale_group:
             debug(f"Scaling {line.name}: {duration / 60 :g}m -> ")
-            duration *= scale_factor
+            duration = duration * scale_num // scale_den
             debugln(f"{duration / 60 :g}m")
         result[station_map[line.name]] = duration
     return result
@@ -95,15 +102,58 @@ def get_name_prefix(config):
     return name_prefix
 
 
-async def upload_schedule(config, day_plan):
-    controller = await get_controller(config)
+def get_upload_limits(config):
+    # how many uploads may be in flight at once, and how many may start per
+    # second (0 for no limit)
+    concurrency = int(config["opensprinkler"].get("upload_concurrency", 4))
+    if concurrency < 1:
+        raise ValueError("[opensprinkler] upload_concurrency must be at least 1")
+    rate = float(config["opensprinkler"].get("upload_rate", 0))
+    if not rate >= 0:
+        raise ValueError("[opensprinkler] upload_rate must be 0 or more")
+    return concurrency, rate
+
+
+async def upload_schedule(controller, config, day_plan):
     station_map = {}
     for id, station in controller.stations.items():
         if station.enabled:
             station_map[station.name] = id
     name_prefix = get_name_prefix(config)
     num_days = len(day_plan)
-
+    # keep a few requests in flight instead of waiting out each round trip, and
+    # optionally also cap how many requests start per second. The controller
+    # appends each new program to its list, so with more than one in flight the
+    # programs may land out of order; with one at a time they land in schedule
+    # order, since the semaphore lets the uploads through in the order below.
+    upload_concurrency, upload_rate = get_upload_limits(config)
+    semaphore = asyncio.Semaphore(upload_concurrency)
+    next_start = 0
+    # once an upload fails, let the ones already in flight finish but start no
+    # more, so it is clear which programs made it onto the controller
+    created = []
+    failed = []
+
+    async def create_limited(name, *args):
+        nonlocal next_start
+        async with semaphore:
+            if upload_rate and not failed:
+                now = asyncio.get_running_loop().time()
+                delay = next_start - now
+                next_start = max(now, next_start) + 1 / upload_rate
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if failed:
+                return
+            try:
+                await create_program(controller, name, *args)
+            except Exception as e:
+                failed.append((name, e))
+            else:
+                created.append(name)
+
+    names = []
+    tasks = []
     for day_num, slot_plan in enumerate(day_plan, start=1):
         for slot_num, line_plan in enumerate(slot_plan, start=1):
             stations = stations_and_durations(station_map, line_plan)
@@ -112,32 +162,29 @@ async def upload_schedule(config, day_plan):
             )
             name = f"{name_prefix}Day {day_num} {slot_name}"
             slot_time = int(config["irrigation"].get(f"slot_{slot_num}_time"))
-            await create_program(
-                controller, name, stations, num_days, day_num - 1, slot_time
+            names.append(name)
+            tasks.append(
+                create_limited(name, stations, num_days, day_num - 1, slot_time)
             )
-            await asyncio.sleep(1)
-
-    await controller.session_close()
-
-
-async def delete_program(controller, name):
-    for idx, program in controller.programs.items():
-        if program.name == name:
-            print("Deleting", name)
-            await controller.delete_program(idx)
-            break
+    await asyncio.gather(*tasks)
+    if failed:
+        for name, e in failed:
+            debugln(f"{name}: failed: {e!r}")
+        debugln("Created: " + ", ".join(n for n in names if n in created))
+        debugln("Not created: " + ", ".join(n for n in names if n not in created))
+        raise failed[0][1]
 
 
-async def delete_autogen(config):
-    controller = await get_controller(config)
+async def delete_autogen(controller, config):
     name_prefix = get_name_prefix(config)
     to_delete = []
-    # We build the list of names first then iterate the programs again for each
-    # deletion, because controller.delete_program takes an index that shifts
-    # around when deleting
-    for program in controller.programs.values():
+    for idx, program in controller.programs.items():
         if program.name.startswith(name_prefix):
-            to_delete.append(program.name)
-    for name in to_delete:
-        await delete_program(controller, name)
-    await controller.session_close()
+            to_delete.append((idx, program.name))
+    # Deleting a program shifts the indices of the ones after it, so go from the
+    # highest index down to keep the remaining indices valid. That also means
+    # the programs don't need to be read back in between, so skip the refresh
+    # the library does after every update.
+    for idx, name in sorted(to_delete, reverse=True):
+        print("Deleting", name)
+        await controller.request("/dp", {"pid": idx}, refresh_on_update=False)
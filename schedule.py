@@ -4,24 +4,50 @@ import argparse
 import asyncio
 import configparser
 import pickle
+import re
 import psycopg
-from collections import namedtuple
+from psycopg import sql
+from collections import defaultdict, namedtuple
 from constraints import plan_schedule
-from controller import upload_schedule, delete_autogen
+from controller import (
+    get_controller,
+    get_upload_limits,
+    upload_schedule,
+    delete_autogen,
+)
 
 Line = namedtuple("Line", ("name", "interval", "duration", "group", "splash"))
 
 
 def get_lines(config):
-    with psycopg.connect(config["database"]["config"]) as conn:
-        conn.execute("SET client_encoding TO utf8")
-        cur = conn.execute(
-            'SELECT name, interval, duration, "group", splash FROM '
-            + config["database"]["table"]
-            + " WHERE interval IS NOT NULL"
+    # the table name may be schema qualified, e.g. "public"."lines"; as in
+    # Postgres, quoted parts are kept as written and unquoted ones are folded to
+    # lowercase
+    name = config["database"]["table"]
+    part = r'\s*("(?:[^"]|"")+"|[^."\s]+)\s*'
+    if not re.fullmatch(rf"{part}(?:\.{part})*", name):
+        raise ValueError(f"[database] table is not a valid table name: {name!r}")
+    table = sql.Identifier(
+        *(
+            p[1:-1].replace('""', '"') if p.startswith('"') else p.lower()
+            for p in re.findall(part, name)
         )
+    )
+    query = sql.SQL(
+        'SELECT name, interval, duration, "group", splash FROM {}'
+        " WHERE interval IS NOT NULL"
+    ).format(table)
+    # set the encoding while connecting and skip the transaction, so the query
+    # is the only round trip after the handshake
+    with psycopg.connect(
+        config["database"]["config"], autocommit=True, client_encoding="utf8"
+    ) as conn:
+        cur = conn.execute(query)
         # convert the splash list into a tuple so we can use Line as dict keys
-        lines = list(map(lambda x: Line._make(x[:4] + (tuple(x[4]),)), cur.fetchall()))
+        lines = [
+            Line(name, interval, duration, group, tuple(splash))
+            for name, interval, duration, group, splash in cur
+        ]
     return lines
 
 
@@ -31,12 +57,10 @@ def print_schedule(day_plan, line_plan):
         print(f"  Day {i}:")
         for j, slot in enumerate(day):
             slot_duration = 0
-            group_duration = {}
+            group_duration = defaultdict(int)
             for line in slot:
                 slot_duration += line.duration
-                group_duration[line.group] = (
-                    group_duration.get(line.group, 0) + line.duration
-                )
+                group_duration[line.group] += line.duration
             print(f"    Slot {j} ({slot_duration : >3} minutes):")
             for group in sorted(group_duration.keys()):
                 print(f"      Group {group} ({group_duration[group]} minutes):")
@@ -46,23 +70,27 @@ def print_schedule(day_plan, line_plan):
                     )
     print()
     print("*** Line plan:")
+    plan_by_name = {line.name: set(plan) for line, plan in line_plan.items()}
     for line, plan in line_plan.items():
-        print(f"  {line.name} (every {line.interval}d): ", end="")
-        for day, slot in plan:
-            print(f"day {day : >2} slot {slot}, ", end="")
-        print()
+        runs = ", ".join(f"day {day : >2} slot {slot}" for day, slot in plan)
+        print(f"  {line.name} (every {line.interval}d): {runs}")
         for splash in line.splash:
-            overlaps = []
-            for splash_line in line_plan.keys():
-                if splash_line.name == splash:
-                    for (pd, ps), (sd, ss) in zip(plan, line_plan[splash_line]):
-                        if pd == sd and ps == ss:
-                            overlaps.append((pd, ps))
+            overlaps = sorted(plan_by_name[line.name] & plan_by_name.get(splash, set()))
             if overlaps:
-                print(f"    overlapping {splash} on: ", end="")
-                for d, s in overlaps:
-                    print(f" day {d} slot {s}, ", end="")
-                print()
+                runs = ", ".join(f"day {d} slot {s}" for d, s in overlaps)
+                print(f"    overlapping {splash} on: {runs}")
+
+
+async def update_controller(config, schedule, delete, upload):
+    # check the upload settings before anything is deleted
+    if upload:
+        get_upload_limits(config)
+    # share one controller connection between deleting and uploading
+    async with get_controller(config) as controller:
+        if delete:
+            await delete_autogen(controller, config)
+        if upload:
+            await upload_schedule(controller, config, schedule[0])
 
 
 def main():
@@ -81,6 +109,11 @@ def main():
         "-r",
         help="Read schedule from this file instead of generating it",
     )
+    parser.add_argument(
+        "--hint_file",
+        "-H",
+        help="Start the solver from the schedule in this file, when generating",
+    )
     parser.add_argument(
         "--print", "-p", default=False, action="store_true", help="Print schedule"
     )
@@ -96,7 +129,8 @@ def main():
         "-d",
         default=False,
         action="store_true",
-        help="Delete autogenerated schedule from controller",
+        help="Delete autogenerated schedule from controller, before uploading if "
+        "--upload is also given",
     )
     args = parser.parse_args()
     config = configparser.ConfigParser()
@@ -108,7 +142,11 @@ def main():
         with open(args.read_file, "rb") as f:
             schedule = pickle.load(f)
     else:
-        schedule = plan_schedule(config, lines)
+        prior_schedule = None
+        if args.hint_file is not None:
+            with open(args.hint_file, "rb") as f:
+                prior_schedule = pickle.load(f)
+        schedule = plan_schedule(config, lines, prior_schedule)
     if not schedule:
         print("No schedule found.")
         return
@@ -118,12 +156,10 @@ def main():
 
     if args.write_file is not None:
         with open(args.write_file, "wb") as f:
-            pickle.dump(schedule, f)
+            pickle.dump(schedule, f, protocol=pickle.HIGHEST_PROTOCOL)
 
-    if args.upload:
-        asyncio.run(upload_schedule(config, schedule[0]))
-    elif args.delete:
-        asyncio.run(delete_autogen(config))
+    if args.delete or args.upload:
+        asyncio.run(update_controller(config, schedule, args.delete, args.upload))
 
 
 if __name__ == "__main__":